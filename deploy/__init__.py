@@ -1 +1,3 @@
 from .ecs.ecr import ECSDeploy
+from .ecs.fleet import FleetDeploy
+from .ecs.history import DeployHistory
@@ -6,6 +6,8 @@ import sys
 import time
 
 from base64 import b64decode
+from .history import DeployHistory, timed_phase
+from .pipeline import run_pipeline
 from .settings import with_defaults, deploy_ini
 
 
@@ -131,6 +133,80 @@ def pprint_docker(byte_msg):
     print(msg)
 
 
+def get_cached_image_id(cache_file):
+    """ cache_file: str
+        -> image_id: str
+
+        Returns the id of the image stored in a `docker save` tarball,
+        read from the tarball's manifest so the image does not need to be
+        loaded first. Returns None if the cache file is missing or unreadable.
+    """
+    import tarfile
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with tarfile.open(cache_file) as tar:
+            manifest = json.load(tar.extractfile('manifest.json'))
+    except (tarfile.TarError, KeyError, ValueError):
+        print('Could not read image manifest from {}.'.format(cache_file))
+        return None
+    # Older docker versions name the config "<id>.json",
+    # newer ones store it as "blobs/sha256/<id>".
+    config = os.path.basename(manifest[0]['Config'])
+    if config.endswith('.json'):
+        config = config[:-len('.json')]
+    return 'sha256:{}'.format(config)
+
+
+def format_size(num_bytes):
+    """ num_bytes: int
+        -> str
+    """
+    return '{:.1f}MB'.format(num_bytes / 1024 / 1024)
+
+
+def diff_image_layers(layers, previous_layers):
+    """ layers: List[Dict]
+        previous_layers: List[Dict]
+        -> List[Tuple[Dict, int]]
+
+        Pairs each layer of an image with its size change relative to the
+        layer at the same position in the previous image. Layers are
+        compared oldest first and only while the commands that created
+        them match; every layer after the first mismatch counts as new.
+    """
+    diff = []
+    matching = True
+    for i, layer in enumerate(layers):
+        matching = (matching and i < len(previous_layers) and
+                    previous_layers[i]['CreatedBy'] == layer['CreatedBy'])
+        previous_size = previous_layers[i]['Size'] if matching else 0
+        diff.append((layer, layer['Size'] - previous_size))
+    return diff
+
+
+def get_image_size_budget(config, name):
+    """ config: Mapping[str, str]
+        name: str
+        -> budget: float
+
+        Returns a size budget in bytes from a megabyte value in the
+        [deploy] section of deploy.ini, or None if it is not set.
+    """
+    value = config.get(name)
+    if not value:
+        return None
+    try:
+        budget = float(value)
+    except ValueError:
+        budget = -1
+    if budget < 0:
+        raise ImageSizeBudgetError(
+            '{} in deploy.ini must be a number of megabytes, '
+            'got {!r}.'.format(name, value))
+    return budget * 1024 * 1024
+
+
 class ECSServiceUpdateError(Exception):
     pass
 
@@ -143,6 +219,14 @@ class MissingRoleError(Exception):
     pass
 
 
+class ImageSizeBudgetError(Exception):
+    pass
+
+
+class ImagePrePullError(Exception):
+    pass
+
+
 class ECSDeploy():
 
     @with_defaults
@@ -158,6 +242,15 @@ class ECSDeploy():
                                                    circle_project_reponame,
                                                    build_tag)
         self.reponame = circle_project_reponame
+        self.build_tag = build_tag
+        # Creating clients from boto3's default session is not thread safe,
+        # so each deploy gets its own session and builds its clients here,
+        # before any steps run concurrently. The clients are thread safe.
+        session = boto3.session.Session(region_name=aws_default_region)
+        self.ecr_client = session.client('ecr')
+        self.ecs_client = session.client('ecs')
+        self.ssm_client = session.client('ssm')
+        self.history = DeployHistory(circle_project_reponame, session=session)
         self.ecs_cluster_basename = aws_ecs_cluster
         self.aws_default_region = aws_default_region
         self.aws_account_id = aws_account_id
@@ -306,10 +399,76 @@ class ECSDeploy():
         build(partial_dockerfile_str, self.partial_tag)
         build(full_dockerfile_str, self.docker_img_url)
 
+    def get_image_layers(self, image):
+        """ image: str
+            -> List[Dict]
+            Returns the history of an image, oldest layer first.
+        """
+        history = self.docker_client.api.history(image)
+        return list(reversed(history))
+
+    def analyze_docker_img(self, previous_image_id=None, size_budget=None,
+                           growth_budget=None):
+        """ previous_image_id: str
+            size_budget: float
+            growth_budget: float
+            -> None
+            Prints the size of the built image and of each of its layers,
+            along with the change from the previously cached image.
+            Raises an ImageSizeBudgetError if the image is larger than
+            size_budget or grew by more than growth_budget, both in bytes.
+        """
+        image_size = self.docker_client.api.inspect_image(
+            self.docker_img_url)['Size']
+        layers = self.get_image_layers(self.docker_img_url)
+
+        previous_size = None
+        previous_layers = []
+        if previous_image_id:
+            try:
+                previous_size = self.docker_client.api.inspect_image(
+                    previous_image_id)['Size']
+                previous_layers = self.get_image_layers(previous_image_id)
+            except docker.errors.ImageNotFound:
+                print('Did not find image {}.'.format(previous_image_id))
+
+        print('Image layers:')
+        for layer, delta in diff_image_layers(layers, previous_layers):
+            delta_msg = ''
+            if delta:
+                delta_msg = '{:+.1f}MB'.format(delta / 1024 / 1024)
+            print('{:>10} {:>10}  {}'.format(format_size(layer['Size']),
+                                             delta_msg,
+                                             layer['CreatedBy'][:100]))
+
+        growth = image_size - previous_size if previous_size else 0
+        msg = 'Image size: {}'.format(format_size(image_size))
+        if previous_size:
+            msg += ' ({:+.1f}MB from cached image)'.format(
+                growth / 1024 / 1024)
+        print(msg)
+
+        if size_budget is not None and image_size > size_budget:
+            raise ImageSizeBudgetError(
+                'Image size {} exceeds budget of {}.'.format(
+                    format_size(image_size), format_size(size_budget)))
+        if growth_budget is not None and growth > growth_budget:
+            raise ImageSizeBudgetError(
+                'Image grew by {} which exceeds budget of {}.'.format(
+                    format_size(growth), format_size(growth_budget)))
+
     def build_docker_img(self, no_use_cache=False, with_circle_hack=False):
+        # Read before building so a bad budget fails fast.
+        size_budget = get_image_size_budget(deploy_ini['deploy'],
+                                            'IMAGE_SIZE_BUDGET_MB')
+        growth_budget = get_image_size_budget(deploy_ini['deploy'],
+                                              'IMAGE_GROWTH_BUDGET_MB')
+        previous_image_id = None
         if not no_use_cache:
             cache_dir = os.path.join(os.path.expanduser('~'), 'docker')
             os.makedirs(cache_dir, exist_ok=True)
+            previous_image_id = get_cached_image_id(
+                os.path.join(cache_dir, 'image.tar'))
             self.load_docker_cache(cache_dir)
 
         if with_circle_hack:
@@ -320,14 +479,26 @@ class ECSDeploy():
 
                 pprint_docker(line)
 
+        # Checked before saving the cache so a rejected image never
+        # becomes the baseline that later builds are compared against.
+        self.analyze_docker_img(previous_image_id, size_budget, growth_budget)
+
         if not no_use_cache:
             self.save_docker_cache(cache_dir, with_circle_hack)
 
-    def test_docker_img(self, test_command):
+    def run_docker_tests(self, test_command, docker_client=None):
+        """ test_command: str
+            docker_client: docker.DockerClient
+            -> None
+            Runs the test command inside the built image, raising a
+            ContainerTestError if the tests fail. A separate docker_client
+            can be given when other steps use the default one concurrently.
+        """
         if not test_command:
             raise ContainerTestError('Test command cannot be empty.')
+        docker_client = docker_client or self.docker_client
         try:
-            log = self.docker_client.containers.run(
+            log = docker_client.containers.run(
                 image=self.docker_img_url,
                 command=test_command,
                 detach=False,
@@ -337,8 +508,14 @@ class ECSDeploy():
             print(log.decode())
         except docker.errors.ContainerError as e:
             print(e)
-            sys.exit('Tests Failed')
+            raise ContainerTestError('Tests Failed')
         print('Tests Passed')
+
+    def test_docker_img(self, test_command):
+        try:
+            self.run_docker_tests(test_command)
+        except ContainerTestError as e:
+            sys.exit(str(e))
         sys.exit(0)
 
     def get_task_def(self, env, memory_reservation, cpu=None,
@@ -389,9 +566,9 @@ class ECSDeploy():
     def push_ecr_image(self):
         """ Utilizes the AWS ECR authorization token to perform a docker
             registry login and push the built image.
+            Returns the digest of the pushed image.
         """
-        ecr = boto3.client('ecr')
-        resp = ecr.get_authorization_token()
+        resp = self.ecr_client.get_authorization_token()
         auth_data = resp['authorizationData'][0]
 
         # The boto3 API returns the authorizationToken as a base64encoded
@@ -409,16 +586,130 @@ class ECSDeploy():
         # On the cli we'd use "docker push repo:tag"
         # but here they need to be split.
         repo, tag = self.docker_img_url.split(':')
+        digest = None
         for line in self.docker_client.api.push(repository=repo, tag=tag,
                                                 stream=True):
             pprint_docker(line)
+            # The final status message carries the digest of the image
+            aux = json.loads(line.decode()).get('aux') or {}
+            digest = aux.get('Digest', digest)
+        return digest
+
+    def get_ecs_instance_ids(self, env):
+        """ env: str
+            -> List[str]
+            Returns the EC2 instance ids of every container instance
+            registered to the environment's ECS cluster.
+        """
+        cluster = get_ecs_cluster_name(self.ecs_cluster_basename, env)
+        client = self.ecs_client
+        paginator = client.get_paginator('list_container_instances')
+        container_instance_arns = []
+        for page in paginator.paginate(cluster=cluster):
+            container_instance_arns.extend(page['containerInstanceArns'])
+
+        instance_ids = []
+        # describe_container_instances accepts at most 100 arns per call
+        for i in range(0, len(container_instance_arns), 100):
+            resp = client.describe_container_instances(
+                cluster=cluster,
+                containerInstances=container_instance_arns[i:i + 100]
+            )
+            instance_ids.extend(c['ec2InstanceId']
+                                for c in resp['containerInstances'])
+        return instance_ids
+
+    def pre_pull_ecs_image(self, env, timeout):
+        """ env: str
+            timeout: int
+
+            Pulls the built image onto every container instance in the
+            cluster with an SSM command, so that new tasks start from a
+            warm image cache once the service is updated. Blocks until
+            every instance has finished pulling and reports the pull time
+            of each. Requires the instances to run the SSM agent with
+            permission to pull from ECR.
+        """
+        instance_ids = self.get_ecs_instance_ids(env)
+        if not instance_ids:
+            print('No container instances to pre-pull image on.')
+            return
+
+        # SSM truncates command output, so the pull is kept quiet and the
+        # pull time comes from the invocation's start and finish times.
+        registry = self.docker_img_url.split('/')[0]
+        commands = [
+            'set -e',
+            'aws ecr get-login-password --region {} | docker login '
+            '--username AWS --password-stdin {} > /dev/null'.format(
+                self.aws_default_region, registry),
+            'docker pull -q {}'.format(self.docker_img_url)
+        ]
+
+        client = self.ssm_client
+        command_ids = []
+        # send_command accepts at most 50 instance ids per call
+        for i in range(0, len(instance_ids), 50):
+            resp = client.send_command(
+                InstanceIds=instance_ids[i:i + 50],
+                DocumentName='AWS-RunShellScript',
+                Comment='Pre-pull {}'.format(self.docker_img_url)[:100],
+                Parameters={'commands': commands}
+            )
+            command_ids.append(resp['Command']['CommandId'])
+        print('Pre-pulling {} on {} instances.'.format(self.docker_img_url,
+                                                       len(instance_ids)))
+
+        pending_statuses = ('Pending', 'InProgress', 'Delayed')
+        timer = 0
+        timer_increment = 5
+        results = {}
+        while (timer < timeout and len(results) < len(instance_ids)):
+            time.sleep(timer_increment)
+            timer += timer_increment
+            for command_id in command_ids:
+                paginator = client.get_paginator('list_command_invocations')
+                for page in paginator.paginate(CommandId=command_id,
+                                               Details=True):
+                    for invocation in page['CommandInvocations']:
+                        instance_id = invocation['InstanceId']
+                        status = invocation['Status']
+                        if (instance_id in results or
+                                status in pending_statuses):
+                            continue
+                        plugins = invocation['CommandPlugins']
+                        output = ''.join(p.get('Output', '')
+                                         for p in plugins)
+                        results[instance_id] = (status, output)
+                        msg = '[{}/{}]'.format(timer, timeout)
+                        msg += '{} {}'.format(instance_id, status)
+                        if (plugins and
+                                plugins[0].get('ResponseStartDateTime') and
+                                plugins[0].get('ResponseFinishDateTime')):
+                            pull_time = (plugins[0]['ResponseFinishDateTime'] -
+                                         plugins[0]['ResponseStartDateTime'])
+                            msg += ', pulled in {:.1f}s'.format(
+                                pull_time.total_seconds())
+                        print(msg)
+
+        missing = [i for i in instance_ids if i not in results]
+        failed = [i for i, (status, _) in results.items()
+                  if status != 'Success']
+        if missing or failed:
+            for instance_id in failed:
+                print('{} output:\n{}'.format(instance_id,
+                                             results[instance_id][1]))
+            raise ImagePrePullError(
+                'Image pre-pull did not succeed. Failed: {}, '
+                'timed out: {}'.format(failed, missing))
+        print('Image pre-pulled on all instances.')
 
     def register_task_def(self, env, task_def, role=None):
         """ Utilizes the boto3 library to register a task definition
             with AWS.
         """
         family = get_ecs_task_name(self.reponame, env, role)
-        client = boto3.client('ecs')
+        client = self.ecs_client
         resp = client.register_task_definition(
             containerDefinitions=[
                 task_def
@@ -435,7 +726,7 @@ class ECSDeploy():
             revisions_to_keep is an integer that represents how many
             previous revisions should be preserved.
         """
-        client = boto3.client('ecs')
+        client = self.ecs_client
         family = get_ecs_task_name(self.reponame, env, role)
         task_def_arns = client.list_task_definitions(
             familyPrefix=family
@@ -448,11 +739,20 @@ class ECSDeploy():
             deregistered_arn = resp['taskDefinition']['taskDefinitionArn']
             print('Deregistered task: {}'.format(deregistered_arn))
 
-    def update_ecs_service(self, env, task_def_revision, timeout, role=None):
+    def update_ecs_service(self, env, task_def_revision, timeout, role=None,
+                           throttle=None):
+        """ Updates the service to a new task definition revision and waits
+            for containers from older revisions to stop. Raises an
+            ECSServiceUpdateError if they are still running after timeout.
+            throttle is an optional callable that is run before each
+            ECS API call, eg. to rate limit calls made against the cluster.
+        """
         service = get_ecs_task_name(self.reponame, env, role)
         cluster = get_ecs_cluster_name(self.ecs_cluster_basename, env)
 
-        client = boto3.client('ecs')
+        client = self.ecs_client
+        if throttle:
+            throttle()
         resp = client.update_service(
             service=service,
             cluster=cluster,
@@ -467,6 +767,8 @@ class ECSDeploy():
         timer_increment = 10
         stale = True
         while (timer < timeout and stale):
+            if throttle:
+                throttle()
             resp = client.describe_services(
                 services=[
                     service
@@ -489,13 +791,58 @@ class ECSDeploy():
             timer += timer_increment
             time.sleep(timer_increment)
 
+        if stale:
+            raise ECSServiceUpdateError(
+                'Timed out after {}s waiting for {} containers from older '
+                'task definitions to stop.'.format(timeout, service))
+
     def backup_secrets(self, s3_bucket):
         backup_secrets(self.reponame, s3_bucket)
 
     def deploy(self, env, memory_reservation, no_service=False, cpu=None,
                memory_reservation_hard=False, ports=None, cmd=None, role=None,
-               timeout=300):
-        self.push_ecr_image()
+               timeout=300, pre_pull=False):
+        family = get_ecs_task_name(self.reponame, env, role)
+        with self.history.recording(family, env, role, self.build_tag,
+                                    save=env != 'test') as record:
+            with timed_phase(record, 'push'):
+                record['image_digest'] = self.push_ecr_image()
+            if pre_pull and env != 'test':
+                with timed_phase(record, 'pre_pull'):
+                    self.pre_pull_ecs_image(env, timeout)
+            task_def = self.get_task_def(env,
+                                         memory_reservation,
+                                         cpu,
+                                         memory_reservation_hard,
+                                         ports,
+                                         cmd,
+                                         role)
+            if env == 'test':
+                from pprint import pprint
+                pprint(task_def)
+            else:
+                with timed_phase(record, 'register'):
+                    task_def_revision = self.register_task_def(env, task_def,
+                                                               role)
+                record['task_def_arn'] = task_def_revision
+                if not no_service:
+                    with timed_phase(record, 'update'):
+                        self.update_ecs_service(env, task_def_revision,
+                                                timeout, role)
+
+    def release(self, env, memory_reservation, test_command,
+                no_use_cache=False, with_circle_hack=False, no_service=False,
+                cpu=None, memory_reservation_hard=False, ports=None, cmd=None,
+                role=None, timeout=300, pre_pull=False):
+        """ Builds, tests, pushes and deploys the image in one invocation.
+            The steps run as a dependency graph rather than serially:
+            once the build finishes, the push, the container tests and the
+            task definition registration run concurrently, and the service
+            update waits on all three. With env 'test' the image is only
+            built and tested, and the task definition is printed.
+            With pre_pull the image is pulled onto the cluster instances
+            after the push, and the service update also waits on that.
+        """
         task_def = self.get_task_def(env,
                                      memory_reservation,
                                      cpu,
@@ -504,9 +851,64 @@ class ECSDeploy():
                                      cmd,
                                      role)
         if env == 'test':
+            # Dry run: check the image builds and passes its tests,
+            # but do not push it or touch ECS.
+            self.build_docker_img(no_use_cache, with_circle_hack)
+            self.run_docker_tests(test_command)
             from pprint import pprint
             pprint(task_def)
-        else:
-            task_def_revision = self.register_task_def(env, task_def, role)
-            if not no_service:
-                self.update_ecs_service(env, task_def_revision, timeout, role)
+            return
+
+        family = get_ecs_task_name(self.reponame, env, role)
+        with self.history.recording(family, env, role,
+                                    self.build_tag) as record:
+            self.run_release_pipeline(record, env, task_def, test_command,
+                                      no_use_cache, with_circle_hack,
+                                      no_service, role, timeout, pre_pull)
+
+    def run_release_pipeline(self, record, env, task_def, test_command,
+                             no_use_cache, with_circle_hack, no_service,
+                             role, timeout, pre_pull):
+        """ Runs the steps of a release, filling in the deploy record
+            as they complete.
+        """
+        def build():
+            self.build_docker_img(no_use_cache, with_circle_hack)
+
+        # The tests run alongside the push, and docker clients are not
+        # safe to share between threads, so they get a client of their own.
+        test_docker_client = docker.from_env(version='1.21')
+
+        def test():
+            self.run_docker_tests(test_command, test_docker_client)
+
+        def push():
+            record['image_digest'] = self.push_ecr_image()
+
+        def register():
+            record['task_def_arn'] = self.register_task_def(env, task_def,
+                                                            role)
+
+        def pre_pull_image():
+            self.pre_pull_ecs_image(env, timeout)
+
+        def update():
+            self.update_ecs_service(env, record['task_def_arn'], timeout,
+                                    role)
+
+        steps = [
+            ('build', build, []),
+            ('test', test, ['build']),
+            ('push', push, ['build']),
+            ('register', register, ['build']),
+        ]
+        update_dependencies = ['test', 'push', 'register']
+        if pre_pull:
+            steps.append(('pre_pull', pre_pull_image, ['push']))
+            update_dependencies.append('pre_pull')
+        if not no_service:
+            steps.append(('update', update, update_dependencies))
+        durations = run_pipeline(steps, record['durations'])
+        print('Release complete: {}'.format(
+            ', '.join('{} {}s'.format(name, durations[name])
+                      for name, _, _ in steps)))
@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from .ecr import ECSDeploy, get_ecs_cluster_name, get_ecs_task_name
+from .history import timed_phase
+
+
+class FleetManifestError(Exception):
+    pass
+
+
+def load_fleet_manifest(manifest_file):
+    """ manifest_file: str
+        -> List[Dict]
+
+        Reads a JSON manifest of services to deploy, eg.
+        {
+            "defaults": {"env": "prod", "memory_reservation": 512},
+            "services": [
+                {"repo": "auth", "tag": "v1.2.3", "ports": [8080]},
+                {"repo": "auth", "tag": "v1.2.3", "role": "worker",
+                 "cmd": ["run_worker"]}
+            ]
+        }
+        Keys in "defaults" apply to every service that does not set them.
+        Services deploy to the cluster basename in AWS_ECS_CLUSTER unless
+        they set "aws_ecs_cluster".
+    """
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    defaults = manifest.get('defaults', {})
+    services = []
+    for entry in manifest.get('services', []):
+        service = dict(defaults, **entry)
+        missing = [k for k in ('repo', 'tag', 'env', 'memory_reservation')
+                   if not service.get(k)]
+        if missing:
+            raise FleetManifestError('Service {} is missing {}.'.format(
+                entry, ', '.join(missing)))
+        services.append(service)
+    return services
+
+
+def get_fleet_service_key(service):
+    """ service: Dict
+        -> str
+        Returns the key a service's progress is checkpointed under,
+        eg. auth-prod-worker:v1.2.3
+    """
+    task_name = get_ecs_task_name(service['repo'], service['env'],
+                                  service.get('role'))
+    return '{}:{}'.format(task_name, service['tag'])
+
+
+class ClusterRateLimiter():
+    """ Spaces out AWS calls made against the same cluster so that a
+        fleet deploy does not trip ECS API throttling.
+    """
+
+    def __init__(self, calls_per_second):
+        if calls_per_second <= 0:
+            raise ValueError('calls_per_second must be greater than 0.')
+        self.interval = 1.0 / calls_per_second
+        self.next_call = {}
+        self.lock = threading.Lock()
+
+    def wait(self, cluster):
+        with self.lock:
+            now = time.time()
+            call_at = max(now, self.next_call.get(cluster, now))
+            self.next_call[cluster] = call_at + self.interval
+        time.sleep(call_at - now)
+
+
+class FleetDeploy():
+
+    def __init__(self, manifest_file, state_file=None, concurrency=4,
+                 rate_limit=1.0):
+        self.services = load_fleet_manifest(manifest_file)
+        self.state_file = state_file or '{}.state'.format(manifest_file)
+        self.concurrency = concurrency
+        self.rate_limiter = ClusterRateLimiter(rate_limit)
+        self.state_lock = threading.Lock()
+        self.state = self.load_state()
+
+    def load_state(self):
+        """ -> Dict
+            Returns the checkpointed progress of a previous run.
+        """
+        if not os.path.isfile(self.state_file):
+            return {}
+        with open(self.state_file, 'r') as f:
+            return json.load(f)
+
+    def checkpoint(self, key, result):
+        """ key: str
+            result: Dict
+            Records a service's result and rewrites the state file
+            atomically so an interrupted run can be resumed.
+        """
+        with self.state_lock:
+            self.state[key] = result
+            tmp_file = '{}.tmp'.format(self.state_file)
+            with open(tmp_file, 'w') as f:
+                json.dump(self.state, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, self.state_file)
+
+    def get_live_environment(self, ecs_deploy, env, role, cluster):
+        """ ecs_deploy: ECSDeploy
+            env: str
+            role: str
+            cluster: str
+            -> List[Dict]
+            Returns the environment of the task definition the service is
+            currently running. Tasks without a service fall back to the
+            latest registered revision. Returns an empty list if neither
+            exists.
+        """
+        family = get_ecs_task_name(ecs_deploy.reponame, env, role)
+        client = ecs_deploy.ecs_client
+        self.rate_limiter.wait(cluster)
+        resp = client.describe_services(services=[family], cluster=cluster)
+        active_services = [s for s in resp['services']
+                           if s['status'] == 'ACTIVE']
+        if active_services:
+            task_def = active_services[0]['taskDefinition']
+        else:
+            task_def = family
+
+        self.rate_limiter.wait(cluster)
+        try:
+            resp = client.describe_task_definition(taskDefinition=task_def)
+        except client.exceptions.ClientException:
+            return []
+        container_defs = resp['taskDefinition']['containerDefinitions']
+        return container_defs[0].get('environment', [])
+
+    def deploy_service(self, service):
+        """ service: Dict
+            -> str
+            Registers a new task definition for a single service and
+            updates the service to it. Environment variables of the
+            task definition the service is running are carried over, with
+            any set for this run (<ENV>_ variables or deploy.ini)
+            taking precedence.
+        """
+        env = service['env']
+        role = service.get('role')
+        ecs_deploy_kwargs = {
+            'circle_project_reponame': service['repo'],
+            'build_tag': service['tag']
+        }
+        # Unset arguments fall back to the environment or deploy.ini
+        if service.get('aws_ecs_cluster'):
+            ecs_deploy_kwargs['aws_ecs_cluster'] = service['aws_ecs_cluster']
+        ecs_deploy = ECSDeploy(**ecs_deploy_kwargs)
+        cluster = get_ecs_cluster_name(ecs_deploy.ecs_cluster_basename, env)
+        task_def = ecs_deploy.get_task_def(
+            env,
+            service['memory_reservation'],
+            service.get('cpu'),
+            service.get('memory_reservation_hard', False),
+            service.get('ports'),
+            service.get('cmd'),
+            role
+        )
+
+        live_env_vars = self.get_live_environment(ecs_deploy, env, role,
+                                                  cluster)
+        env_vars = {d['name']: d['value'] for d in live_env_vars}
+        env_vars.update({d['name']: d['value']
+                         for d in task_def['environment']})
+        task_def['environment'] = [{'name': k, 'value': v}
+                                   for k, v in sorted(env_vars.items())]
+
+        family = get_ecs_task_name(service['repo'], env, role)
+        with ecs_deploy.history.recording(family, env, role,
+                                          service['tag']) as record:
+            self.rate_limiter.wait(cluster)
+            with timed_phase(record, 'register'):
+                revision = ecs_deploy.register_task_def(env, task_def, role)
+            record['task_def_arn'] = revision
+            if not service.get('no_service', False):
+                with timed_phase(record, 'update'):
+                    ecs_deploy.update_ecs_service(
+                        env, revision, service.get('timeout', 300), role,
+                        throttle=lambda: self.rate_limiter.wait(cluster))
+        return revision
+
+    def run_service(self, service):
+        key = get_fleet_service_key(service)
+        print('Deploying {}.'.format(key))
+        start = time.time()
+        try:
+            revision = self.deploy_service(service)
+        except Exception as e:
+            print('Failed {}: {}'.format(key, e))
+            self.checkpoint(key, {'status': 'failed', 'error': str(e)})
+        else:
+            print('Deployed {} as {}.'.format(key, revision))
+            self.checkpoint(key, {'status': 'done', 'revision': revision,
+                                  'duration': time.time() - start})
+
+    def deploy(self):
+        """ -> List[str]
+            Deploys every service in the manifest that was not already
+            completed by a previous run, at most `concurrency` at a time.
+            Returns the keys of the services that failed.
+        """
+        pending = []
+        for service in self.services:
+            key = get_fleet_service_key(service)
+            if self.state.get(key, {}).get('status') == 'done':
+                print('Skipping {}, already deployed.'.format(key))
+            else:
+                pending.append(service)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(self.run_service, pending))
+
+        keys = [get_fleet_service_key(s) for s in self.services]
+        done = [k for k in keys if self.state[k]['status'] == 'done']
+        failed = [k for k in keys if self.state[k]['status'] == 'failed']
+        print('Fleet deploy complete: {} deployed, {} failed.'.format(
+            len(done), len(failed)))
+        for key in failed:
+            print('  {}: {}'.format(key, self.state[key]['error']))
+        return failed
@@ -0,0 +1,275 @@
+import boto3
+import json
+import os
+import re
+import time
+import uuid
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from .settings import deploy_ini
+
+
+# <repo>/<family>/<stamp>-<id>-<tag>.json
+HISTORY_KEY_RE = re.compile(
+    r'^[^/]+/(?P<family>[^/]+)/'
+    r'(?P<stamp>\d{8}T\d{6}\.\d{6}Z)-[0-9a-f]{8}-(?P<tag>[^/]+)\.json$')
+
+HISTORY_TIMESTAMP_FORMATS = [
+    '%Y-%m-%d',
+    '%Y-%m-%dT%H:%M:%SZ',
+    '%Y-%m-%dT%H:%M:%S.%fZ',
+    '%Y-%m-%dT%H:%M:%S%z',
+    '%Y-%m-%dT%H:%M:%S.%f%z',
+]
+
+
+class InvalidHistoryTimestamp(Exception):
+    pass
+
+
+def get_history_setting(name):
+    """ name: str
+        -> str
+        Returns a history setting from deploy.ini or the environment.
+    """
+    return deploy_ini['deploy'].get(name) or os.environ.get(name)
+
+
+def parse_history_timestamp(timestamp):
+    """ timestamp: str
+        -> datetime
+        Parses a date or an ISO 8601 timestamp into a UTC datetime.
+        Timestamps must end in Z or give a UTC offset, and dates are
+        taken as midnight UTC.
+    """
+    # Offsets with a colon (eg. -04:00) are not understood by %z
+    # before Python 3.7.
+    normalized = re.sub(r'([+-]\d\d):(\d\d)$', r'\1\2', timestamp)
+    for timestamp_format in HISTORY_TIMESTAMP_FORMATS:
+        try:
+            parsed = datetime.strptime(normalized, timestamp_format)
+        except ValueError:
+            continue
+        if parsed.tzinfo:
+            parsed = parsed.astimezone(timezone.utc)
+        return parsed.replace(tzinfo=timezone.utc)
+    raise InvalidHistoryTimestamp(
+        'Cannot read {!r}, expected a date (2017-07-12) or a timestamp '
+        'with a timezone (2017-07-12T19:13:12Z).'.format(timestamp))
+
+
+def get_history_stamp(timestamp):
+    """ timestamp: str
+        -> str
+        Converts a date or ISO 8601 timestamp into the compact UTC form
+        used in history keys,
+        eg. 2017-07-12T15:13:12-04:00 -> 20170712T191312.000000Z
+        Stamps all have the same length and sort in the same order as the
+        times they represent, so date ranges can be matched without
+        reading any records.
+    """
+    parsed = parse_history_timestamp(timestamp)
+    return parsed.strftime('%Y%m%dT%H%M%S.%fZ')
+
+
+@contextmanager
+def timed_phase(record, phase):
+    """ record: Dict
+        phase: str
+        Records how long the wrapped block takes under the record's
+        durations, whether or not it succeeds.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        record['durations'][phase] = round(time.time() - start, 1)
+
+
+class DeployHistory():
+    """ A log of deploys for a single repo, stored as one JSON file per
+        deploy in S3 (DEPLOY_HISTORY_S3_BUCKET) or on local disk
+        (DEPLOY_HISTORY_DIR, default ~/.ecs_deploy/history).
+        Records are keyed <repo>/<family>/<stamp>-<id>-<tag>.json so
+        queries by env, tag or date are answered from the keys alone,
+        without reading records that cannot match. The random id keeps
+        deploys that start in the same second from overwriting each other.
+    """
+
+    s3_prefix = 'deploy-history'
+
+    def __init__(self, reponame, history_dir=None, s3_bucket=None,
+                 session=None):
+        self.reponame = reponame
+        self.s3_bucket = (s3_bucket or
+                          get_history_setting('DEPLOY_HISTORY_S3_BUCKET'))
+        if self.s3_bucket:
+            # Built once up front, as clients from boto3's default session
+            # cannot be created safely from concurrent threads.
+            session = session or boto3.session.Session()
+            self.s3_client = session.client('s3')
+        self.history_dir = (
+            history_dir or
+            get_history_setting('DEPLOY_HISTORY_DIR') or
+            os.path.join(os.path.expanduser('~'), '.ecs_deploy', 'history'))
+
+    def list_keys(self):
+        """ -> List[str]
+            Returns the keys of every record for the repo, relative to
+            the history root.
+        """
+        if self.s3_bucket:
+            client = self.s3_client
+            paginator = client.get_paginator('list_objects_v2')
+            prefix = '{}/{}/'.format(self.s3_prefix, self.reponame)
+            keys = []
+            for page in paginator.paginate(Bucket=self.s3_bucket,
+                                           Prefix=prefix):
+                keys.extend(obj['Key'][len(self.s3_prefix) + 1:]
+                            for obj in page.get('Contents', []))
+            return keys
+
+        repo_dir = os.path.join(self.history_dir, self.reponame)
+        keys = []
+        for root, dirnames, files in os.walk(repo_dir):
+            for filename in files:
+                file_path = os.path.join(root, filename)
+                key = os.path.relpath(file_path, self.history_dir)
+                keys.append(key.replace(os.sep, '/'))
+        return keys
+
+    def read_record(self, key):
+        """ key: str
+            -> Dict
+        """
+        if self.s3_bucket:
+            client = self.s3_client
+            resp = client.get_object(
+                Bucket=self.s3_bucket,
+                Key='{}/{}'.format(self.s3_prefix, key)
+            )
+            return json.loads(resp['Body'].read().decode())
+
+        with open(os.path.join(self.history_dir, key), 'r') as f:
+            return json.load(f)
+
+    def write_record(self, key, record):
+        """ key: str
+            record: Dict
+        """
+        json_blob = json.dumps(record, sort_keys=True)
+        if self.s3_bucket:
+            client = self.s3_client
+            client.put_object(
+                ACL='private',
+                Body=bytes(json_blob, 'utf-8'),
+                Bucket=self.s3_bucket,
+                ContentEncoding='utf-8',
+                ContentType='application/json',
+                Key='{}/{}'.format(self.s3_prefix, key)
+            )
+            return
+
+        file_path = os.path.join(self.history_dir, key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as f:
+            f.write(json_blob)
+
+    def append(self, record):
+        """ record: Dict
+            Saves a deploy record. A deploy should never fail because its
+            history could not be saved, so errors are only printed.
+        """
+        key = '{}/{}/{}-{}-{}.json'.format(
+            self.reponame,
+            record['family'],
+            get_history_stamp(record['started_at']),
+            record['id'],
+            record['tag'].replace('/', '_'))
+        try:
+            self.write_record(key, record)
+        except Exception as e:
+            print('Could not save deploy history {}: {}'.format(key, e))
+
+    @contextmanager
+    def recording(self, family, env, role, tag, save=True):
+        """ family: str
+            env: str
+            role: str
+            tag: str
+            save: bool
+
+            Yields a new deploy record to be filled in by the deploy and
+            saves it on exit along with the total duration and outcome.
+            Pass save=False for dry runs.
+        """
+        record = {
+            'id': uuid.uuid4().hex[:8],
+            'repo': self.reponame,
+            'family': family,
+            'env': env,
+            'role': role,
+            'tag': tag,
+            'task_def_arn': None,
+            'image_digest': None,
+            'started_at': datetime.now(timezone.utc).strftime(
+                '%Y-%m-%dT%H:%M:%S.%fZ'),
+            'durations': {},
+            'outcome': None
+        }
+        start = time.time()
+        try:
+            yield record
+            record['outcome'] = 'success'
+        except BaseException as e:
+            record['outcome'] = 'failed'
+            record['error'] = str(e)
+            raise
+        finally:
+            record['duration'] = round(time.time() - start, 1)
+            if save:
+                self.append(record)
+
+    def query(self, env=None, role=None, tag=None, since=None, until=None,
+              outcome=None, limit=20):
+        """ -> List[Dict]
+            Returns up to `limit` records, newest first. since is inclusive
+            and until is exclusive; both take a date or ISO 8601 timestamp
+            and raise InvalidHistoryTimestamp if they cannot be read.
+            env, tag and the date range are matched against record keys,
+            so only records that may be returned are read. Files that are
+            not named like records are ignored.
+        """
+        since_stamp = get_history_stamp(since) if since else None
+        until_stamp = get_history_stamp(until) if until else None
+        candidates = []
+        for key in self.list_keys():
+            match = HISTORY_KEY_RE.match(key)
+            if not match:
+                continue
+            family, stamp, key_tag = match.group('family', 'stamp', 'tag')
+            if env and not family.startswith(
+                    '{}-{}'.format(self.reponame, env)):
+                continue
+            if tag and key_tag != tag.replace('/', '_'):
+                continue
+            if since_stamp and stamp < since_stamp:
+                continue
+            if until_stamp and stamp >= until_stamp:
+                continue
+            candidates.append((stamp, key))
+
+        records = []
+        for stamp, key in sorted(candidates, reverse=True):
+            record = self.read_record(key)
+            if env and record['env'] != env:
+                continue
+            if role and record['role'] != role:
+                continue
+            if outcome and record['outcome'] != outcome:
+                continue
+            records.append(record)
+            if len(records) >= limit:
+                break
+        return records
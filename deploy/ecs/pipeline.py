@@ -0,0 +1,66 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PipelineStepError(Exception):
+    pass
+
+
+def run_pipeline(steps, durations=None):
+    """ steps: List[Tuple[str, Callable, List[str]]]
+        durations: Dict[str, float]
+        -> Dict[str, float]
+
+        Runs a list of (name, func, dependencies) steps as a dependency
+        graph. Each step starts as soon as every step it depends on has
+        finished, so independent steps run concurrently and the total
+        runtime is roughly the longest path through the graph.
+        Steps must be listed after their dependencies.
+
+        Returns the duration in seconds of each completed step, which is
+        also written to `durations` if given so that it survives a failure.
+        If a step fails, the steps depending on it are not run and the
+        first failure is re-raised once the running steps have finished.
+    """
+    futures = {}
+    if durations is None:
+        durations = {}
+
+    def run_step(name, func, dependencies):
+        for dependency in dependencies:
+            try:
+                futures[dependency].result()
+            except Exception:
+                raise PipelineStepError('Skipped {}: dependency {} '
+                                        'failed.'.format(name, dependency))
+        print('Starting {}.'.format(name))
+        start = time.time()
+        func()
+        durations[name] = round(time.time() - start, 1)
+        print('Finished {} in {}s.'.format(name, durations[name]))
+
+    # Check the whole graph before anything runs.
+    seen = set()
+    for name, func, dependencies in steps:
+        unknown = [d for d in dependencies if d not in seen]
+        if unknown:
+            raise PipelineStepError('Step {} depends on unknown or later '
+                                    'steps: {}'.format(name, unknown))
+        seen.add(name)
+
+    # Every step gets its own worker; a step blocked on its dependencies
+    # must never starve the steps it is waiting on.
+    with ThreadPoolExecutor(max_workers=len(steps) or 1) as executor:
+        for name, func, dependencies in steps:
+            futures[name] = executor.submit(run_step, name, func,
+                                            dependencies)
+
+    # Re-raise the root cause rather than the cascade of skipped steps.
+    errors = [f.exception() for f in futures.values() if f.exception()]
+    root_errors = [e for e in errors if not isinstance(e, PipelineStepError)]
+    if root_errors:
+        raise root_errors[0]
+    elif errors:
+        raise errors[0]
+    return durations
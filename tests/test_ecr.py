@@ -0,0 +1,131 @@
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from unittest import mock
+from deploy.ecs.ecr import (ECSDeploy, ECSServiceUpdateError,
+                            ImageSizeBudgetError, diff_image_layers,
+                            get_cached_image_id, get_image_size_budget)
+
+
+def layer(created_by, size):
+    return {'CreatedBy': created_by, 'Size': size}
+
+
+class DiffImageLayersTest(unittest.TestCase):
+
+    def test_matching_layers_report_size_change(self):
+        previous = [layer('FROM base', 100), layer('RUN pip install', 50)]
+        current = [layer('FROM base', 100), layer('RUN pip install', 80)]
+        diff = diff_image_layers(current, previous)
+        self.assertEqual([delta for _, delta in diff], [0, 30])
+
+    def test_layers_after_mismatch_are_new(self):
+        previous = [layer('FROM base', 100), layer('RUN apt-get', 20),
+                    layer('COPY . /app', 5)]
+        current = [layer('FROM base', 100), layer('RUN apk add', 10),
+                   layer('COPY . /app', 5)]
+        diff = diff_image_layers(current, previous)
+        self.assertEqual([delta for _, delta in diff], [0, 10, 5])
+
+    def test_no_previous_image(self):
+        current = [layer('FROM base', 100), layer('COPY . /app', 5)]
+        diff = diff_image_layers(current, [])
+        self.assertEqual([delta for _, delta in diff], [100, 5])
+
+
+class GetCachedImageIdTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.cache_dir, 'image.tar')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def write_manifest(self, config):
+        manifest = json.dumps([{'Config': config}]).encode('utf-8')
+        with tarfile.open(self.cache_file, mode='w') as tar:
+            tar_info = tarfile.TarInfo('manifest.json')
+            tar_info.size = len(manifest)
+            tar.addfile(tar_info, io.BytesIO(manifest))
+
+    def test_json_config_name(self):
+        self.write_manifest('abc123.json')
+        self.assertEqual(get_cached_image_id(self.cache_file),
+                         'sha256:abc123')
+
+    def test_blob_config_name(self):
+        self.write_manifest('blobs/sha256/abc123')
+        self.assertEqual(get_cached_image_id(self.cache_file),
+                         'sha256:abc123')
+
+    def test_missing_cache_file(self):
+        self.assertIsNone(get_cached_image_id(self.cache_file))
+
+    def test_missing_manifest(self):
+        with tarfile.open(self.cache_file, mode='w'):
+            pass
+        self.assertIsNone(get_cached_image_id(self.cache_file))
+
+
+class GetImageSizeBudgetTest(unittest.TestCase):
+
+    def test_unset(self):
+        self.assertIsNone(get_image_size_budget({}, 'IMAGE_SIZE_BUDGET_MB'))
+
+    def test_megabytes_to_bytes(self):
+        config = {'IMAGE_SIZE_BUDGET_MB': '1.5'}
+        self.assertEqual(get_image_size_budget(config, 'IMAGE_SIZE_BUDGET_MB'),
+                         1.5 * 1024 * 1024)
+
+    def test_invalid_value(self):
+        for value in ('800MB', '-1'):
+            config = {'IMAGE_SIZE_BUDGET_MB': value}
+            with self.assertRaises(ImageSizeBudgetError):
+                get_image_size_budget(config, 'IMAGE_SIZE_BUDGET_MB')
+
+
+class FakeECSClient():
+
+    def __init__(self, deployments):
+        self.deployments = deployments
+
+    def update_service(self, service, cluster, taskDefinition):
+        return {'service': {'taskDefinition': taskDefinition}}
+
+    def describe_services(self, services, cluster):
+        return {'services': [{'deployments': self.deployments}]}
+
+
+class UpdateECSServiceTest(unittest.TestCase):
+
+    def get_ecs_deploy(self, deployments):
+        ecs_deploy = ECSDeploy.__new__(ECSDeploy)
+        ecs_deploy.reponame = 'auth'
+        ecs_deploy.ecs_cluster_basename = 'http'
+        ecs_deploy.ecs_client = FakeECSClient(deployments)
+        return ecs_deploy
+
+    @mock.patch('deploy.ecs.ecr.time.sleep')
+    def test_completes_when_old_deployments_stop(self, sleep):
+        ecs_deploy = self.get_ecs_deploy([{'taskDefinition': 'arn:2',
+                                           'runningCount': 1}])
+        ecs_deploy.update_ecs_service('prod', 'arn:2', timeout=30)
+
+    @mock.patch('deploy.ecs.ecr.time.sleep')
+    def test_raises_when_old_deployments_outlive_timeout(self, sleep):
+        throttle = mock.Mock()
+        ecs_deploy = self.get_ecs_deploy([
+            {'taskDefinition': 'arn:2', 'runningCount': 0},
+            {'taskDefinition': 'arn:1', 'runningCount': 2}
+        ])
+        with self.assertRaises(ECSServiceUpdateError):
+            ecs_deploy.update_ecs_service('prod', 'arn:2', timeout=30,
+                                          throttle=throttle)
+        # update_service plus one describe_services per poll
+        self.assertEqual(throttle.call_count, 4)
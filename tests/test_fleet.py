@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from deploy.ecs.fleet import (ClusterRateLimiter, FleetManifestError,
+                              get_fleet_service_key, load_fleet_manifest)
+
+
+class LoadFleetManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manifest_dir = tempfile.mkdtemp()
+        self.manifest_file = os.path.join(self.manifest_dir, 'fleet.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.manifest_dir)
+
+    def write_manifest(self, manifest):
+        with open(self.manifest_file, 'w') as f:
+            json.dump(manifest, f)
+
+    def test_defaults_apply_unless_overridden(self):
+        self.write_manifest({
+            'defaults': {'env': 'prod', 'memory_reservation': 512},
+            'services': [
+                {'repo': 'auth', 'tag': 'v1'},
+                {'repo': 'search', 'tag': 'v2', 'memory_reservation': 1024,
+                 'aws_ecs_cluster': 'search'}
+            ]
+        })
+        auth, search = load_fleet_manifest(self.manifest_file)
+        self.assertEqual(auth['memory_reservation'], 512)
+        self.assertNotIn('aws_ecs_cluster', auth)
+        self.assertEqual(search['memory_reservation'], 1024)
+        self.assertEqual(search['aws_ecs_cluster'], 'search')
+        self.assertEqual(search['env'], 'prod')
+
+    def test_missing_required_keys(self):
+        self.write_manifest({'services': [{'repo': 'auth', 'tag': 'v1'}]})
+        with self.assertRaises(FleetManifestError):
+            load_fleet_manifest(self.manifest_file)
+
+    def test_service_key(self):
+        service = {'repo': 'auth', 'env': 'prod', 'role': 'worker',
+                   'tag': 'v1'}
+        self.assertEqual(get_fleet_service_key(service),
+                         'auth-prod-worker:v1')
+
+
+class ClusterRateLimiterTest(unittest.TestCase):
+
+    def test_rejects_non_positive_rate(self):
+        for rate in (0, -1):
+            with self.assertRaises(ValueError):
+                ClusterRateLimiter(rate)
@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from deploy.ecs.history import (HISTORY_KEY_RE, DeployHistory,
+                                InvalidHistoryTimestamp, get_history_stamp)
+
+
+class GetHistoryStampTest(unittest.TestCase):
+
+    def test_date(self):
+        self.assertEqual(get_history_stamp('2017-07-12'),
+                         '20170712T000000.000000Z')
+
+    def test_utc_timestamp(self):
+        self.assertEqual(get_history_stamp('2017-07-12T19:13:12Z'),
+                         '20170712T191312.000000Z')
+        self.assertEqual(get_history_stamp('2017-07-12T19:13:12.250000Z'),
+                         '20170712T191312.250000Z')
+
+    def test_offset_converted_to_utc(self):
+        self.assertEqual(get_history_stamp('2017-07-12T15:13:12-04:00'),
+                         '20170712T191312.000000Z')
+
+    def test_rejects_timestamp_without_timezone(self):
+        for timestamp in ('2017-07-12T19:13:12', 'last tuesday'):
+            with self.assertRaises(InvalidHistoryTimestamp):
+                get_history_stamp(timestamp)
+
+
+class DeployHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.history_dir = tempfile.mkdtemp()
+        self.history = DeployHistory('auth', history_dir=self.history_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.history_dir)
+
+    def append(self, started_at, family='auth-prod', env='prod', role=None,
+               tag='v1', outcome='success', id_='00000000'):
+        self.history.append({
+            'id': id_,
+            'family': family,
+            'env': env,
+            'role': role,
+            'tag': tag,
+            'started_at': started_at,
+            'outcome': outcome
+        })
+
+    def test_recording_saves_keyed_record(self):
+        with self.history.recording('auth-prod-web', 'prod', 'web',
+                                    'release/v1') as record:
+            record['task_def_arn'] = 'arn:1'
+        key, = self.history.list_keys()
+        self.assertTrue(HISTORY_KEY_RE.match(key))
+        self.assertTrue(key.startswith('auth/auth-prod-web/'))
+        self.assertTrue(key.endswith('-release_v1.json'))
+        record, = self.history.query()
+        self.assertEqual(record['outcome'], 'success')
+        self.assertEqual(record['task_def_arn'], 'arn:1')
+
+    def test_recording_marks_failures(self):
+        with self.assertRaises(RuntimeError):
+            with self.history.recording('auth-prod', 'prod', None, 'v1'):
+                raise RuntimeError('Timed out')
+        record, = self.history.query()
+        self.assertEqual(record['outcome'], 'failed')
+        self.assertEqual(record['error'], 'Timed out')
+
+    def test_recording_skips_dry_runs(self):
+        with self.history.recording('auth-test', 'test', None, 'v1',
+                                    save=False):
+            pass
+        self.assertEqual(self.history.list_keys(), [])
+
+    def test_same_second_records_do_not_collide(self):
+        for _ in range(2):
+            with self.history.recording('auth-prod', 'prod', None, 'v1'):
+                pass
+        self.assertEqual(len(self.history.query()), 2)
+
+    def test_newest_first_within_a_second(self):
+        # The ids sort the other way, so only the timestamp orders these
+        self.append('2017-07-12T19:13:12.000001Z', id_='ffffffff')
+        self.append('2017-07-12T19:13:12.000002Z', id_='00000000')
+        records = self.history.query(limit=1)
+        self.assertEqual(records[0]['started_at'],
+                         '2017-07-12T19:13:12.000002Z')
+
+    def test_ignores_stray_files(self):
+        self.append('2017-07-12T19:13:12.000000Z')
+        os.makedirs(os.path.join(self.history_dir, 'auth', 'auth-prod'),
+                    exist_ok=True)
+        for stray in ('.DS_Store', os.path.join('auth-prod', 'notes.txt')):
+            open(os.path.join(self.history_dir, 'auth', stray), 'w').close()
+        self.assertEqual(len(self.history.query()), 1)
+
+    def test_filters(self):
+        self.append('2017-07-11T10:00:00.000000Z', tag='v1')
+        self.append('2017-07-12T10:00:00.000000Z', tag='v2',
+                    family='auth-prod-worker', role='worker')
+        self.append('2017-07-12T11:00:00.000000Z', tag='v2',
+                    family='auth-demo', env='demo', outcome='failed')
+
+        def tags(**kwargs):
+            return [(r['env'], r['tag']) for r in self.history.query(**kwargs)]
+
+        self.assertEqual(tags(env='prod'), [('prod', 'v2'), ('prod', 'v1')])
+        self.assertEqual(tags(role='worker'), [('prod', 'v2')])
+        self.assertEqual(tags(tag='v2'), [('demo', 'v2'), ('prod', 'v2')])
+        self.assertEqual(tags(outcome='failed'), [('demo', 'v2')])
+        self.assertEqual(tags(since='2017-07-12'),
+                         [('demo', 'v2'), ('prod', 'v2')])
+        self.assertEqual(tags(until='2017-07-12'), [('prod', 'v1')])
+        self.assertEqual(tags(since='2017-07-12T06:30:00-04:00'),
+                         [('demo', 'v2')])
+        self.assertEqual(tags(limit=1), [('demo', 'v2')])
@@ -0,0 +1,59 @@
+import unittest
+
+from deploy.ecs.pipeline import PipelineStepError, run_pipeline
+
+
+def fail():
+    raise ValueError('build failed')
+
+
+class RunPipelineTest(unittest.TestCase):
+
+    def test_runs_every_step(self):
+        ran = []
+        durations = run_pipeline([
+            ('build', lambda: ran.append('build'), []),
+            ('test', lambda: ran.append('test'), ['build']),
+            ('push', lambda: ran.append('push'), ['build']),
+        ])
+        self.assertEqual(ran[0], 'build')
+        self.assertEqual(sorted(ran), ['build', 'push', 'test'])
+        self.assertEqual(sorted(durations), ['build', 'push', 'test'])
+
+    def test_dependents_skipped_after_failure(self):
+        ran = []
+        with self.assertRaises(ValueError):
+            run_pipeline([
+                ('build', fail, []),
+                ('test', lambda: ran.append('test'), ['build']),
+                ('update', lambda: ran.append('update'), ['test']),
+            ])
+        self.assertEqual(ran, [])
+
+    def test_reraises_root_cause(self):
+        with self.assertRaises(ValueError) as cm:
+            run_pipeline([
+                ('build', fail, []),
+                ('test', lambda: None, ['build']),
+            ])
+        self.assertNotIsInstance(cm.exception, PipelineStepError)
+        self.assertEqual(str(cm.exception), 'build failed')
+
+    def test_durations_kept_for_finished_steps(self):
+        durations = {}
+        with self.assertRaises(ValueError):
+            run_pipeline([
+                ('register', lambda: None, []),
+                ('build', fail, ['register']),
+            ], durations)
+        self.assertEqual(list(durations), ['register'])
+
+    def test_rejects_steps_before_dependencies(self):
+        ran = []
+        with self.assertRaises(PipelineStepError):
+            run_pipeline([
+                ('register', lambda: ran.append('register'), []),
+                ('test', lambda: ran.append('test'), ['build']),
+                ('build', lambda: ran.append('build'), []),
+            ])
+        self.assertEqual(ran, [])